@@ -1,16 +1,22 @@
 import pytest
 from brownie import GTC, TokenDistributor, Timelock, accounts, web3, Wei, reverts, chain
 import brownie
+from hexbytes import HexBytes
+from eth_abi import encode_abi
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import json
 import hmac
 import hashlib
-import binascii
 import csv
+import functools
 import random
 import os
 import sys
+import warnings
 from dotenv import dotenv_values
 
 #load up envars from .env
@@ -21,11 +27,33 @@ except Exception as e:
     print(f'There was an issue getting envars from file. Please check that file exists and values are correct format: {e}')
     sys.exit(1)
 
+# one pooled session for all ESMS calls so claims reuse the same TCP/TLS connections
+ESMS_WORKERS = 32
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=ESMS_WORKERS, pool_maxsize=ESMS_WORKERS, max_retries=Retry(total=3, backoff_factor=0.1)))
+
+# key the HMAC once; each claim signs a copy of this template 
+try:
+    HMAC_TEMPLATE = hmac.new(bytes.fromhex(env['DEV_HMAC_KEY']), None, hashlib.sha256)
+except Exception as e:
+    print(f'There was an issue loading DEV_HMAC_KEY. Please check it is set to a hex encoded key: {e}')
+    sys.exit(1)
+
+# ESMS claim body has a fixed shape, so format it directly rather than going through json.dumps per claim.
+# must stay byte-for-byte what json.dumps would emit, as the ESMS checks our HMAC against the body
+CLAIM_PAYLOAD = '{{"user_id": {}, "user_address": "{}", "delegate_address": "{}", "user_amount": {}}}'
+assert CLAIM_PAYLOAD.format(1, '0x0', '0x0', 10**21) == json.dumps({'user_id': 1, 'user_address': '0x0', 'delegate_address': '0x0', 'user_amount': 10**21})
+
 # confirm we can hit the ESMS
 try:
-    esms_response = requests.get(env['V1_API_URL'])
+    # goes through SESSION so the TLS handshake is done here and the connection is reused by the first claims
+    esms_response = SESSION.get(env['V1_API_URL'])
+    # pooling only helps if the ESMS keeps connections open between requests
+    # (warned rather than printed so it lands in pytest's warnings summary)
+    if (esms_response.headers.get('Connection', '').lower() == 'close'):
+        warnings.warn('ESMS closes the connection after each request, every claim will pay for a new TLS handshake')
     # we should get a 405 from GET request to POST only endpoint 
-    if (esms_response.status_code != '405'):
+    if (esms_response.status_code != 405):
         raise Exception("ESMS does not appear to be responding to requests") 
     print(f'Response from ESMS: {esms_response.status_code}')
 except Exception as e:
@@ -76,6 +104,12 @@ def seed(token, td):
     '''Tansfer seed tokens to the distributor contract'''
     return token.transfer(td.address, Wei('1000000 ether'), {'from': accounts[0]})
 
+@pytest.fixture(scope="module")
+def valid_token_claim():
+    '''Signed claim for the known valid user; the ESMS response doesn't change between tests so we only request it once'''
+    valid_claim = ValidClaim() # get known valid claim base metadata 
+    return TokenClaim(valid_claim.user_id, valid_claim.claim_address, valid_claim.delegate_address, valid_claim.total_claim) # get signed token claim from the EMSM
+
 @pytest.fixture(autouse=True)
 def isolation(fn_isolation):
     '''snapshot/isolate the env after above fixtures so the tests below run against a clean snapshot'''
@@ -85,21 +119,25 @@ def test_valid_contract_address(token, td):
     '''generic test to confirm we have a working contract address'''
     assert web3.isChecksumAddress(token.address) and web3.isChecksumAddress(token.address), "One or more contract addresses could not be validated. Please confirm contracts we're deployed as expected."
  
-def test_dist_address_on_token(token, td):
-    token.setGTCDist(td.address, {'from': accounts[0]})
+def test_dist_address_on_token(token, td, set_dist_address):
     assert token.GTCDist() != '0x0000000000000000000000000000000000000000', "Token doesn't have the TokenDistribution contract address set appropriately for delegation on dist."
 
-def test_valid_claim(token,td,seed,set_dist_address): 
+def test_valid_claim(token,td,seed,set_dist_address,valid_token_claim): 
     '''
        Submit claim to ESMS use respone to make on-chain claim.
        Test that a valid claim will transfer tokens to user  
     '''
 
-    valid_claim = ValidClaim() # get known valid claim base metadata 
-    token_claim = TokenClaim(valid_claim.user_id, valid_claim.claim_address, valid_claim.delegate_address, valid_claim.total_claim) # get signed token claim from the EMSM
+    token_claim = valid_token_claim
+
+    # the ESMS leaf should match the contract's leaf hash as recomputed locally 
+    assert HexBytes(token_claim.leaf) == compute_leaf(token_claim.user_id, token_claim.user_amount), "ESMS leaf does not match the locally computed leaf"
+
+    # the ESMS proof should verify locally against the same root the contract was deployed with 
+    assert verify_proof(token_claim.proof, env['MERKLE_ROOT'], token_claim.leaf), "ESMS proof does not verify against MERKLE_ROOT"
     
     # get use balance before claim 
-    balance_before = token.balanceOf(valid_claim.claim_address)
+    balance_before = token.balanceOf(token_claim.user_address)
 
     # place token claim 
     td.claimTokens(token_claim.user_id, token_claim.user_address, token_claim.user_amount, token_claim.delegate_address, token_claim.hash, token_claim.sig, token_claim.proof, token_claim.leaf, {'from' : token_claim.user_address})
@@ -114,25 +152,23 @@ def test_valid_claim(token,td,seed,set_dist_address):
     # uncomment to debug and print details to stdout 
     # assert False, "You intentionally triggered execpetion to print debug info to stdout"
 
-def test_claim_from_different_source(token,td,set_dist_address):
+def test_claim_from_different_source(token,td,set_dist_address,valid_token_claim):
     '''
     The token distribution contract is designed to only allow a claim to proceed if the 
     msg.sender address matches the user_account address provided in the signed message object.
     ''' 
-    valid_claim = ValidClaim() # get known valid claim base metadata 
-    token_claim = TokenClaim(valid_claim.user_id, valid_claim.claim_address, valid_claim.delegate_address, valid_claim.total_claim) # get signed token claim from the EMSM
+    token_claim = valid_token_claim
     
     # should revert as we're sending claim from different msg.sender 
     with brownie.reverts("TokenDistributor: Must be msg sender."):
         td.claimTokens(token_claim.user_id, token_claim.user_address, token_claim.user_amount, token_claim.delegate_address, token_claim.hash, token_claim.sig, token_claim.proof, token_claim.leaf, {'from' : accounts[2].address})
 
-def test_only_claim_once(token,td,set_dist_address):
+def test_only_claim_once(token,td,set_dist_address,valid_token_claim):
     '''
     Token distribution contract is designed to only allow a given user (as per the initial_dist.csv)
     claim tokens exactly one time. Should revert if user attempts to claim twice
     '''
-    valid_claim = ValidClaim() # get known valid claim base metadata 
-    token_claim = TokenClaim(valid_claim.user_id, valid_claim.claim_address, valid_claim.delegate_address, valid_claim.total_claim) # get signed token claim from the EMSM
+    token_claim = valid_token_claim
     
     # should be successful claim 
     td.claimTokens(token_claim.user_id, token_claim.user_address, token_claim.user_amount, token_claim.delegate_address, token_claim.hash, token_claim.sig, token_claim.proof, token_claim.leaf, {'from' : token_claim.user_address}
@@ -142,20 +178,37 @@ def test_only_claim_once(token,td,set_dist_address):
     with brownie.reverts("TokenDistributor: Tokens already claimed."):
         td.claimTokens(token_claim.user_id, token_claim.user_address, token_claim.user_amount, token_claim.delegate_address, token_claim.hash, token_claim.sig, token_claim.proof, token_claim.leaf, {'from' : token_claim.user_address})
   
-def test_claim_fails_with_bad_metadata(token,td,set_dist_address):
+def test_claim_fails_with_bad_metadata(token,td,set_dist_address,valid_token_claim):
     '''
     In addition to checking if a claim is signed by the expected acccount
     we also confirm that key metadata provided with the claim can 
     be re-hashed to create the original message that was signed. 
     This helps ensure integrity of the claim. 
     '''
-    valid_claim = ValidClaim() # get known valid claim base metadata 
-    token_claim = TokenClaim(valid_claim.user_id, valid_claim.claim_address, valid_claim.delegate_address, valid_claim.total_claim) # get signed token claim from the EMSM
+    token_claim = valid_token_claim
     
     # should revert as we send a different claim amount than that of which was provided with the original message 
     with brownie.reverts("TokenDistributor: Claim Hash Mismatch."):
         td.claimTokens(token_claim.user_id, token_claim.user_address, 1223943873000000061440, token_claim.delegate_address, token_claim.hash, token_claim.sig, token_claim.proof, token_claim.leaf, {'from' : token_claim.user_address})
 
+def test_verify_proof_sorted_pair_tree():
+    '''
+    Check the local MerkleProof.verify port against a small tree built by hand:
+    root = hash(hash(a, b), c) where hash sorts each pair before hashing
+    '''
+    def hash_pair(x, y):
+        return web3.keccak(min(x, y) + max(x, y))
+
+    leaf_a, leaf_b, leaf_c = (web3.keccak(text=name) for name in ('a', 'b', 'c'))
+    node_ab = hash_pair(leaf_a, leaf_b)
+    root = hash_pair(node_ab, leaf_c)
+
+    assert verify_proof([leaf_b.hex(), leaf_c.hex()], root.hex(), leaf_a.hex()), "Proof for leaf a should verify"
+    assert verify_proof([leaf_a, leaf_c], root, leaf_b), "Proof for leaf b should verify"
+    assert verify_proof([node_ab], root, leaf_c), "Proof for leaf c should verify"
+    assert not verify_proof([leaf_b, leaf_c], root, leaf_c), "Proof should not verify for a leaf that isn't in that position"
+    assert not verify_proof([leaf_b], root, leaf_a), "Incomplete proof should not verify"
+
 def test_wrong_user(token,td,set_dist_address): 
     '''
        This test case emulates a scenario where the signed message service is tricked into signing a claim 
@@ -172,33 +225,44 @@ def test_wrong_user(token,td,set_dist_address):
 def _full_dist_list(token, td, seed, set_dist_address):
     '''Iterate though and test every claim on the list'''
   
-    with open(env['DIST_FILE'], 'r') as csvfile:
-        initial_distribution = csv.reader(csvfile)
-        next(initial_distribution) # skip header 
-        
-        for row in initial_distribution:
-            random_index = random.randint(0, 9) # pick a random number for address index 
-            user_id = int(row[1]) # user_id 
-            total_claim = int(row[2]) # total_claim
-            claim_address = accounts[random_index].address # set random address 
-            delegate_address = claim_address # self delegate 
-                   
-            # get balance before  
-            balance_before = token.balanceOf(claim_address)
-            
-            # craft claim object 
-            token_claim = TokenClaim(user_id, claim_address, delegate_address, total_claim)
-            
-            # make claim
-            try: 
-                claim_tx = td.claimTokens(token_claim.user_id, token_claim.user_address, token_claim.user_amount, token_claim.delegate_address, token_claim.hash, token_claim.sig, token_claim.proof, token_claim.leaf, {'from' : claim_address})
-            except Exception as e:
-                print(f'TokenDistribution test: There was an issue sending claim to the contract: {e}') 
+    claim_addresses = [account.address for account in accounts[:10]] # look up the candidate addresses once 
+    claims = []
+    for user_id, total_claim in load_dist_rows():
+        claim_address = random.choice(claim_addresses) # set random address 
+        delegate_address = claim_address # self delegate 
+        claims.append((user_id, claim_address, delegate_address, total_claim))
+
+    # sign every claim with the ESMS up front, overlapping the network round trips
+    with ThreadPoolExecutor(max_workers=ESMS_WORKERS) as executor:
+        token_claims = list(executor.map(lambda claim: TokenClaim(*claim), claims))
+
+    # a claim that doesn't verify against our leaf/root can only revert on-chain, so fail fast here instead
+    for token_claim in token_claims:
+        assert HexBytes(token_claim.leaf) == compute_leaf(token_claim.user_id, token_claim.user_amount), f"Leaf for user_id {token_claim.user_id} does not match the claim"
+        assert verify_proof(token_claim.proof, env['MERKLE_ROOT'], token_claim.leaf), f"Proof for user_id {token_claim.user_id} does not verify against MERKLE_ROOT"
+
+    # claims only ever land on claim_addresses, so read those balances once before and once after rather than per claim
+    balances_before = {address: token.balanceOf(address) for address in claim_addresses}
+    expected_claimed = dict.fromkeys(claim_addresses, 0)
+
+    # on-chain claims still have to go out one at a time 
+    failed_user_ids = []
+    for token_claim in token_claims:
+        claim_address = token_claim.user_address
+        expected_claimed[claim_address] += token_claim.user_amount
         
-            # get use balance before claim 
-            balance_after = token.balanceOf(claim_address)
-     
-            assert balance_before < balance_after, "Token claim failed"
+        # make claim
+        try: 
+            claim_tx = td.claimTokens(token_claim.user_id, token_claim.user_address, token_claim.user_amount, token_claim.delegate_address, token_claim.hash, token_claim.sig, token_claim.proof, token_claim.leaf, {'from' : claim_address})
+        except Exception as e:
+            failed_user_ids.append(token_claim.user_id)
+            print(f'TokenDistribution test: There was an issue sending claim to the contract: {e}') 
+
+    assert not failed_user_ids, f"Token claim failed for user_ids: {failed_user_ids}"
+
+    for claim_address in claim_addresses:
+        balance_after = token.balanceOf(claim_address)
+        assert balance_after - balances_before[claim_address] == expected_claimed[claim_address], f"Token claim failed for {claim_address}"
              
     # uncomment to debug and print details to stdout 
     # assert False, "You intentionally triggered execpetion to print debug info to stdout"
@@ -213,7 +277,8 @@ def test_sweep_unclaimed_drops_1(token, td, set_dist_address):
     '''
     deploy_time = td.deployTime()
     drop_active = td.CONTRACT_ACTIVE()
-    time.sleep(5) # sleep for 10 seconds
+    chain.sleep(5) # advance chain time 5 seconds without waiting on the wall clock
+    chain.mine()
     current_time = chain.time()
    
     if (current_time >= deploy_time + drop_active): # airdrop is no longer live, anyone can sweep all funds to Timelock
@@ -229,39 +294,54 @@ def test_sweep_unclaimed_drops_1(token, td, set_dist_address):
         with brownie.reverts("TokenDistributor: Contract is still active."):
             td.transferUnclaimed({'from': accounts[0]})
 
-def get_claim_from_dist():
-    '''Pull back a single valid claim from initial dist list'''
+@functools.lru_cache(maxsize=None)
+def load_dist_rows():
+    '''Read the initial dist list once and return its (user_id, total_claim) rows'''
   
     with open(env['DIST_FILE'], 'r') as csvfile:
         initial_distribution = csv.reader(csvfile)
         next(initial_distribution) # skip header 
         
-        for row in initial_distribution:
-            user_id = int(row[1]) # user_id 
-            total_claim = int(row[2]) # total_claim
-            print(f'HERE: {user_id}, {total_claim}')
-            return(user_id, total_claim)
+        # total_claim can exceed 64 bits, so keep both as python ints
+        return tuple((int(row[1]), int(row[2])) for row in initial_distribution)
+
+def get_claim_from_dist():
+    '''Pull back a single valid claim from initial dist list'''
+    user_id, total_claim = load_dist_rows()[0]
+    print(f'HERE: {user_id}, {total_claim}')
+    return(user_id, total_claim)
+
+@functools.lru_cache(maxsize=None)
+def get_claim_address():
+    '''Address the reusable claims below are made from/delegated to, looked up once'''
+    return accounts[1].address
 
 # reusable, valid claim pulled from first record in initial_dist file 
 class ValidClaim:    
+    __slots__ = ('user_id', 'claim_address', 'delegate_address', 'total_claim')
+
     def __init__(self):
         _user_id, _total_claim = get_claim_from_dist()
         self.user_id = _user_id
-        self.claim_address = accounts[1].address 
-        self.delegate_address = accounts[1].address
+        self.claim_address = get_claim_address() 
+        self.delegate_address = self.claim_address
         self.total_claim = _total_claim
 
 # reusable, bad claim contains 2x defined total_claim 
 class BadClaim1:
+    __slots__ = ('user_id', 'claim_address', 'delegate_address', 'total_claim')
+
     def __init__(self):
         _user_id, _total_claim = get_claim_from_dist()
         self.user_id = _user_id
-        self.claim_address = accounts[1].address 
-        self.delegate_address = accounts[1].address
+        self.claim_address = get_claim_address() 
+        self.delegate_address = self.claim_address
         self.total_claim = _total_claim + _total_claim
 
 # for crafting full signed, token claim objects  
 class TokenClaim:
+    __slots__ = ('user_id', 'user_address', 'user_amount', 'delegate_address', 'hash', 'sig', 'leaf', 'proof')
+
     def __init__(self, _user_id, _user_address, _delegate_address, _total_claim):
         ''' push claim objects emitted from Ethereum Message
             Signing Service into an on-chain claimable object 
@@ -280,16 +360,13 @@ class TokenClaim:
 def generate_claim(user_id, user_address, delegate_address, total_claim):
     '''Mimic Quadratic Lands application by sending a claim request to the Ethereum Signed Message Service'''
     
-    post_data_to_emss = {}
-    post_data_to_emss['user_id'] = user_id
-    post_data_to_emss['user_address'] = user_address
-    post_data_to_emss['delegate_address'] = delegate_address
-    post_data_to_emss['user_amount'] = total_claim
+    # serialise once; the same body is both HMAC'd and POSTed
+    post_data_to_emss = CLAIM_PAYLOAD.format(int(user_id), user_address, delegate_address, int(total_claim))
 
-    # print(f'POST DATA FOR ESMS: {json.dumps(post_data_to_emss)}')
+    # print(f'POST DATA FOR ESMS: {post_data_to_emss}')
     # create a hash of post data
     try:                 
-        hmac_signed_claim = create_sha256_signature(env['DEV_HMAC_KEY'], json.dumps(post_data_to_emss))
+        hmac_signed_claim = create_sha256_signature(post_data_to_emss)
     except: 
         print('Error creating hash of POST data for ESMS')
 
@@ -300,7 +377,7 @@ def generate_claim(user_id, user_address, delegate_address, total_claim):
 
     # POST relevant user data to micro service that returns signed transation data for the user broadcast
     try: 
-        emss_response = requests.post(env['V1_API_URL'], data=json.dumps(post_data_to_emss), headers=header)
+        emss_response = SESSION.post(env['V1_API_URL'], data=post_data_to_emss, headers=header)
         emss_response_content = emss_response.content
         emss_response.raise_for_status() # raise exception on error 
     except requests.exceptions.ConnectionError:
@@ -319,7 +396,7 @@ def generate_claim(user_id, user_address, delegate_address, total_claim):
     
     try:
         # ESMS returns may retrun objects. so, we decode 
-        full_response = json.loads(emss_response_content.decode('utf-8'))
+        full_response = json.loads(emss_response_content)
     except Exception as e:
         full_response = []
         print(f'TokenDistribution test Error - {e}')
@@ -328,13 +405,26 @@ def generate_claim(user_id, user_address, delegate_address, total_claim):
     return full_response 
     
 
-def create_sha256_signature(key, message):
-    '''Given key & message, returns HMAC digest of the message'''
+def compute_leaf(user_id, user_amount):
+    '''Rebuild a claim's merkle leaf the same way TokenDistributor does: keccak256(abi.encode(keccak256(abi.encode(user_id, user_amount))))'''
+    return web3.keccak(encode_abi(['bytes32'], [web3.keccak(encode_abi(['uint32', 'uint256'], [user_id, user_amount]))]))
+
+def verify_proof(proof, root, leaf):
+    '''Local port of OpenZeppelin's MerkleProof.verify (sorted-pair keccak256) used by TokenDistributor'''
+    computed_hash = HexBytes(leaf)
+    for proof_element in map(HexBytes, proof):
+        if computed_hash <= proof_element:
+            computed_hash = web3.keccak(computed_hash + proof_element)
+        else:
+            computed_hash = web3.keccak(proof_element + computed_hash)
+    return computed_hash == HexBytes(root)
+
+def create_sha256_signature(message):
+    '''Given message, returns HMAC digest of the message keyed with DEV_HMAC_KEY'''
     try:
-        byte_key = binascii.unhexlify(key)
-        message = message.encode()
-        return hmac.new(byte_key, message, hashlib.sha256).hexdigest().upper()
+        signature = HMAC_TEMPLATE.copy()
+        signature.update(message.encode())
+        return signature.hexdigest().upper()
     except Exception as e:
-        logger.error(f'TokenDistribtor - Error Hashing Message: {e}')
+        print(f'TokenDistribtor - Error Hashing Message: {e}')
         return False 
-